@@ -323,14 +323,10 @@ class App:
         self._hub_manager.blank_screen()
 
     def on_button_press_state_changed(self, button_pressed, is_pressed):
-        if button_pressed == "Up":
-            self._publish_server.publish_up_button_press_state_changed(is_pressed)
-        elif button_pressed == "Down":
-            self._publish_server.publish_down_button_press_state_changed(is_pressed)
-        elif button_pressed == "Select":
-            self._publish_server.publish_select_button_press_state_changed(is_pressed)
-        elif button_pressed == "Cancel":
-            self._publish_server.publish_cancel_button_press_state_changed(is_pressed)
+        if button_pressed in ("Up", "Down", "Select", "Cancel"):
+            self._publish_server.publish_button_press_state_changed(
+                button_pressed.lower(), is_pressed
+            )
 
     def on_device_id_changed(self, device_id_int):
         # Inform the power manager that the device id has changed, so
@@ -1,7 +1,7 @@
 import logging
-import traceback
+import queue
 from os import getenv
-from threading import Lock
+from threading import Thread
 
 import zmq
 from pitop.common.ptdm import Message
@@ -12,130 +12,164 @@ logger = logging.getLogger(__name__)
 # Creates a server for clients to connect to,
 # and publishes state change messages to these clients
 class PublishServer:
+    # Endpoint for subscribers living in the pi-topd process itself -
+    # avoids the TCP loopback round-trip (requires the shared context)
+    INPROC_URI = "inproc://pitopd.pub"
+
+    # Sentinel posted to the send queue to wake the sender thread on shutdown
+    _SHUTDOWN_SENTINEL = None
+
+    # Maximum number of queued messages drained per sender wake-up
+    _MAX_BATCH = 64
+
+    # Parameterless publish messages always serialize to the same wire
+    # bytes - build and encode each of them once instead of on every publish
+    _STATIC_WIRE = {
+        message_id: Message.from_parts(message_id).to_string().encode("utf-8")
+        for message_id in (
+            Message.PUB_UNSUPPORTED_HARDWARE,
+            Message.PUB_SHUTDOWN_REQUESTED,
+            Message.PUB_REBOOT_REQUIRED,
+            Message.PUB_SCREEN_BLANKED,
+            Message.PUB_SCREEN_UNBLANKED,
+            Message.PUB_LOW_BATTERY_WARNING,
+            Message.PUB_CRITICAL_BATTERY_WARNING,
+            Message.PUB_LID_OPENED,
+            Message.PUB_LID_CLOSED,
+            Message.PUB_V3_BUTTON_UP_PRESSED,
+            Message.PUB_V3_BUTTON_UP_RELEASED,
+            Message.PUB_V3_BUTTON_DOWN_PRESSED,
+            Message.PUB_V3_BUTTON_DOWN_RELEASED,
+            Message.PUB_V3_BUTTON_SELECT_PRESSED,
+            Message.PUB_V3_BUTTON_SELECT_RELEASED,
+            Message.PUB_V3_BUTTON_CANCEL_PRESSED,
+            Message.PUB_V3_BUTTON_CANCEL_RELEASED,
+            Message.PUB_PITOPD_READY,
+        )
+    }
+
     def __init__(self):
         self.emit_messages = False
-        self._socket_lock = Lock()
         self._shutting_down = False
         self._zmq_context = None
         self._zmq_socket = None
+        # Producers enqueue pre-serialized payloads; only the sender
+        # thread ever touches the zmq socket, so no lock is needed.
+        # Publishes come from several threads (hub, battery, idle monitor,
+        # peripheral manager), so the queue must stay multi-producer safe -
+        # SimpleQueue is C-implemented and holds no Python-level lock
+        self._tx_queue = queue.SimpleQueue()
+        self._sender_thread = None
+        self._dropped_message_count = 0
         self._enable_battery_logging = getenv("PT_LOG_BATTERY_CHANGE", "0") == "1"
 
     def start_listening(self):
         logger.debug("Opening publisher socket...")
 
         try:
-            self._socket_lock.acquire()
-
-            self._zmq_context = zmq.Context()
-            self._zmq_socket = self._zmq_context.socket(zmq.PUB)
+            # Shared with RequestServer - one libzmq IO thread pool per process
+            self._zmq_context = zmq.Context.instance()
+            # XPUB with NODROP makes a full subscriber queue surface as
+            # zmq.Again in the sender loop instead of a silent drop.
+            # Don't be tempted by CONFLATE/RADIO for the state-style events:
+            # all message ids share this socket, and newest-wins retention
+            # ignores topics, so a battery tick would eat e.g. the latest
+            # brightness event
+            self._zmq_socket = self._zmq_context.socket(zmq.XPUB)
+            self._zmq_socket.setsockopt(zmq.XPUB_NODROP, 1)
+            self._zmq_socket.setsockopt(zmq.SNDHWM, 10000)
+            self._zmq_socket.setsockopt(zmq.LINGER, 0)
             self._zmq_socket.bind("tcp://*:3781")
-            logger.debug("Publish server ready...")
-
-            return True
+            self._zmq_socket.bind(self.INPROC_URI)
 
         except zmq.error.ZMQError as e:
             logger.error("Error starting the publish server: " + str(e))
-            logger.info(traceback.format_exc())
+            logger.info("Stack trace:", exc_info=True)
 
             return False
 
-        finally:
-            self._socket_lock.release()
+        self._shutting_down = False
+        self._sender_thread = Thread(target=self._sender_loop, daemon=True)
+        self._sender_thread.start()
+        logger.debug("Publish server ready...")
+
+        return True
 
     def stop_listening(self):
         logger.debug("Closing publisher socket...")
 
-        try:
-            self._socket_lock.acquire()
-            self._shutting_down = True
+        self._shutting_down = True
+        self._tx_queue.put(self._SHUTDOWN_SENTINEL)
+        if self._sender_thread is not None and self._sender_thread.is_alive():
+            self._sender_thread.join()
 
+        try:
             if self._zmq_socket is not None:
+                # The context is shared with RequestServer, so only close
+                # this server's socket - never destroy the context here
                 self._zmq_socket.close()
-                self._zmq_context.destroy()
             logger.debug("Closed publisher socket.")
 
         except zmq.error.ZMQError as e:
-            logger.error("Error starting the publish server: " + str(e))
-            logger.info(traceback.format_exc())
+            logger.error("Error stopping the publish server: " + str(e))
+            logger.info("Stack trace:", exc_info=True)
 
-        finally:
-            self._socket_lock.release()
+    # The parameterless publish_* methods (see _SIMPLE_PUBLISHES at the
+    # bottom of this module) are generated rather than hand-written
 
     def publish_brightness_changed(self, new_brightness: int):
-        PublishServer._check_type(new_brightness, int)
+        assert isinstance(new_brightness, int), "Wrong type to be sent in message"
         self._send_message(Message.PUB_BRIGHTNESS_CHANGED, [new_brightness])
 
     def publish_peripheral_connected(self, peripheral_id: int):
-        PublishServer._check_type(peripheral_id, int)
+        assert isinstance(peripheral_id, int), "Wrong type to be sent in message"
         self._send_message(Message.PUB_PERIPHERAL_CONNECTED, [peripheral_id])
 
     def publish_peripheral_disconnected(self, peripheral_id: int):
-        PublishServer._check_type(peripheral_id, int)
+        assert isinstance(peripheral_id, int), "Wrong type to be sent in message"
         self._send_message(Message.PUB_PERIPHERAL_DISCONNECTED, [peripheral_id])
 
-    def publish_unsupported_hardware(self):
-        self._send_message(Message.PUB_UNSUPPORTED_HARDWARE)
-
-    def publish_shutdown_requested(self):
-        self._send_message(Message.PUB_SHUTDOWN_REQUESTED)
-
-    def publish_reboot_required(self):
-        self._send_message(Message.PUB_REBOOT_REQUIRED)
-
     def publish_battery_state_changed(
         self, connected: int, new_capacity: int, new_time: int, new_wattage: int
     ):
-        PublishServer._check_type(connected, int)
-        PublishServer._check_type(new_capacity, int)
-        PublishServer._check_type(new_time, int)
-        PublishServer._check_type(new_wattage, int)
+        assert (
+            isinstance(connected, int)
+            and isinstance(new_capacity, int)
+            and isinstance(new_time, int)
+            and isinstance(new_wattage, int)
+        ), "Wrong type to be sent in message"
         self._send_message(
             Message.PUB_BATTERY_STATE_CHANGED,
             [connected, new_capacity, new_time, new_wattage],
             log_message=self._enable_battery_logging,
         )
 
-    def publish_screen_blanked(self):
-        self._send_message(Message.PUB_SCREEN_BLANKED)
-
-    def publish_screen_unblanked(self):
-        self._send_message(Message.PUB_SCREEN_UNBLANKED)
-
-    def publish_low_battery_warning(self):
-        self._send_message(Message.PUB_LOW_BATTERY_WARNING)
-
-    def publish_critical_battery_warning(self):
-        self._send_message(Message.PUB_CRITICAL_BATTERY_WARNING)
-
-    def publish_lid_opened(self):
-        self._send_message(Message.PUB_LID_OPENED)
-
-    def publish_lid_closed(self):
-        self._send_message(Message.PUB_LID_CLOSED)
+    # (button, is_pressed) -> V3 button publish message id
+    _BUTTON_MESSAGES = {
+        ("up", True): Message.PUB_V3_BUTTON_UP_PRESSED,
+        ("up", False): Message.PUB_V3_BUTTON_UP_RELEASED,
+        ("down", True): Message.PUB_V3_BUTTON_DOWN_PRESSED,
+        ("down", False): Message.PUB_V3_BUTTON_DOWN_RELEASED,
+        ("select", True): Message.PUB_V3_BUTTON_SELECT_PRESSED,
+        ("select", False): Message.PUB_V3_BUTTON_SELECT_RELEASED,
+        ("cancel", True): Message.PUB_V3_BUTTON_CANCEL_PRESSED,
+        ("cancel", False): Message.PUB_V3_BUTTON_CANCEL_RELEASED,
+    }
+
+    def publish_button_press_state_changed(self, button, is_pressed):
+        self._send_message(self._BUTTON_MESSAGES[(button, bool(is_pressed))])
 
     def publish_up_button_press_state_changed(self, is_pressed):
-        if is_pressed:
-            self._send_message(Message.PUB_V3_BUTTON_UP_PRESSED)
-        else:
-            self._send_message(Message.PUB_V3_BUTTON_UP_RELEASED)
+        self.publish_button_press_state_changed("up", is_pressed)
 
     def publish_down_button_press_state_changed(self, is_pressed):
-        if is_pressed:
-            self._send_message(Message.PUB_V3_BUTTON_DOWN_PRESSED)
-        else:
-            self._send_message(Message.PUB_V3_BUTTON_DOWN_RELEASED)
+        self.publish_button_press_state_changed("down", is_pressed)
 
     def publish_select_button_press_state_changed(self, is_pressed):
-        if is_pressed:
-            self._send_message(Message.PUB_V3_BUTTON_SELECT_PRESSED)
-        else:
-            self._send_message(Message.PUB_V3_BUTTON_SELECT_RELEASED)
+        self.publish_button_press_state_changed("select", is_pressed)
 
     def publish_cancel_button_press_state_changed(self, is_pressed):
-        if is_pressed:
-            self._send_message(Message.PUB_V3_BUTTON_CANCEL_PRESSED)
-        else:
-            self._send_message(Message.PUB_V3_BUTTON_CANCEL_RELEASED)
+        self.publish_button_press_state_changed("cancel", is_pressed)
 
     def publish_oled_pi_controlled_state_changed(self, oled_controlled_by_pi):
         self._send_message(
@@ -147,44 +181,100 @@ class PublishServer:
             Message.PUB_OLED_SPI_BUS_CHANGED, [0 if oled_uses_spi0 else 1]
         )
 
-    def publish_pitopd_ready(self):
-        self._send_message(Message.PUB_PITOPD_READY)
-
     # Internal functions
     def _send_message(self, message_id, parameters=None, log_message=True):
-        if parameters is None:
-            parameters = list()
-        message = Message.from_parts(message_id, parameters)
+        if parameters:
+            message = Message.from_parts(message_id, parameters)
+            payload = message.to_string().encode("utf-8")
+            friendly = message.message_friendly_string
+        else:
+            # The friendly form of a parameterless message is just its name
+            payload = self._STATIC_WIRE[message_id]
+
+            def friendly():
+                return Message.name_for_id(message_id)
 
         if self._zmq_socket is None or not self.emit_messages:
-            msg = f"Not publishing message: {message.message_friendly_string()}"
-            msg += (
-                " - publish server not ready"
-                if self._zmq_socket is None
-                else " - pi-topd not initialized"
-            )
-            logger.info(msg)
+            # Only pay for friendly-stringification if the log gets emitted
+            if logger.isEnabledFor(logging.INFO):
+                reason = (
+                    "publish server not ready"
+                    if self._zmq_socket is None
+                    else "pi-topd not initialized"
+                )
+                logger.info("Not publishing message: %s - %s", friendly(), reason)
             return
 
-        if log_message:
-            logger.info("Publishing message: " + message.message_friendly_string())
-
-        try:
-            self._socket_lock.acquire()
-            if self._shutting_down is True:
-                return
-
-            self._zmq_socket.send_string(message.to_string())
-            logger.debug("Published message: " + message.message_friendly_string())
-
-        except zmq.error.ZMQError as e:
-            logger.error("Communication error in publish server: " + str(e))
-            logger.info(traceback.format_exc())
-
-        finally:
-            self._socket_lock.release()
-
-    @staticmethod
-    def _check_type(var, var_type):
-        if isinstance(var, var_type) is False:
-            raise TypeError("Wrong type to be sent in message")
+        if log_message and logger.isEnabledFor(logging.INFO):
+            logger.info("Publishing message: %s", friendly())
+
+        self._tx_queue.put_nowait(payload)
+
+    def _sender_loop(self):
+        while True:
+            # Block for the first message, then drain any burst in one go
+            # so bursts cost a single wake-up rather than one per message
+            batch = [self._tx_queue.get()]
+            try:
+                while len(batch) < self._MAX_BATCH:
+                    batch.append(self._tx_queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            for payload in batch:
+                if payload is self._SHUTDOWN_SENTINEL or self._shutting_down:
+                    return
+
+                try:
+                    self._zmq_socket.send(payload, zmq.DONTWAIT)
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("Published message: %s", payload.decode("utf-8"))
+
+                except zmq.error.Again:
+                    self._dropped_message_count += 1
+                    logger.warning(
+                        "Subscriber queue full - dropped message: %s (%d dropped in total)",
+                        payload.decode("utf-8"),
+                        self._dropped_message_count,
+                    )
+
+                except zmq.error.ZMQError as e:
+                    logger.error("Communication error in publish server: " + str(e))
+                    logger.info("Stack trace:", exc_info=True)
+
+            # XPUB surfaces (un)subscription messages on the receive side;
+            # drain them so they do not pile up against the receive HWM
+            try:
+                while True:
+                    self._zmq_socket.recv(zmq.DONTWAIT)
+            except zmq.error.Again:
+                pass
+
+
+# Every parameterless publish_* method has the same one-line body;
+# generate them from this spec instead of hand-writing each
+_SIMPLE_PUBLISHES = {
+    "publish_unsupported_hardware": Message.PUB_UNSUPPORTED_HARDWARE,
+    "publish_shutdown_requested": Message.PUB_SHUTDOWN_REQUESTED,
+    "publish_reboot_required": Message.PUB_REBOOT_REQUIRED,
+    "publish_screen_blanked": Message.PUB_SCREEN_BLANKED,
+    "publish_screen_unblanked": Message.PUB_SCREEN_UNBLANKED,
+    "publish_low_battery_warning": Message.PUB_LOW_BATTERY_WARNING,
+    "publish_critical_battery_warning": Message.PUB_CRITICAL_BATTERY_WARNING,
+    "publish_lid_opened": Message.PUB_LID_OPENED,
+    "publish_lid_closed": Message.PUB_LID_CLOSED,
+    "publish_pitopd_ready": Message.PUB_PITOPD_READY,
+}
+
+
+def _make_simple_publish_method(name, message_id):
+    def publish(self):
+        self._send_message(message_id)
+
+    publish.__name__ = name
+    publish.__qualname__ = f"PublishServer.{name}"
+    return publish
+
+
+for _name, _message_id in _SIMPLE_PUBLISHES.items():
+    setattr(PublishServer, _name, _make_simple_publish_method(_name, _message_id))
@@ -1,7 +1,5 @@
 import logging
-import traceback
 from threading import Thread
-from time import sleep
 
 import zmq
 from pitop.common.common_ids import DeviceID
@@ -13,14 +11,17 @@ logger = logging.getLogger(__name__)
 # Creates a server for clients to connect to, and then responds to
 # queries from these clients for device-related debug information.
 class RequestServer:
-    _thread = Thread()
+    _thread: Thread
 
     def __init__(self):
         self._thread = Thread(target=self._thread_method)
         self._continue = False
         self._callback_client = None
-        self._zmq_context = zmq.Context()
+        # Shared with PublishServer - one libzmq IO thread pool per process
+        self._zmq_context = zmq.Context.instance()
         self._zmq_socket = self._zmq_context.socket(zmq.REP)
+        self._stop_send_socket = None
+        self._stop_recv_socket = None
 
     def initialise(self, callback_client):
         self._callback_client = callback_client
@@ -29,17 +30,25 @@ class RequestServer:
         logger.debug("Opening request socket...")
 
         try:
+            # inproc pair used to wake the request thread immediately on
+            # shutdown - named per instance, since the context is shared
+            # process-wide and a fixed name could still be held by a
+            # previous instance until the context's reaper releases it
+            stop_uri = f"inproc://request-server-stop-{id(self)}"
+            self._stop_send_socket = self._zmq_context.socket(zmq.PAIR)
+            self._stop_send_socket.bind(stop_uri)
+            self._stop_recv_socket = self._zmq_context.socket(zmq.PAIR)
+            self._stop_recv_socket.connect(stop_uri)
+
             self._zmq_socket.bind("tcp://*:3782")
             logger.debug("Request server ready...")
 
         except zmq.error.ZMQError as e:
             logger.error("Error starting the request server: " + str(e))
-            logger.info(traceback.format_exc())
+            logger.info("Stack trace:", exc_info=True)
 
             return False
 
-        sleep(0.5)
-
         self._continue = True
         self._thread.start()
 
@@ -50,196 +59,230 @@ class RequestServer:
 
         self._continue = False
         if self._thread.is_alive():
+            self._stop_send_socket.send(b"")
             self._thread.join()
 
+        # The context is shared with PublishServer, so only close this
+        # server's sockets - never destroy the context here
         self._zmq_socket.close()
-        self._zmq_context.destroy()
+        if self._stop_send_socket is not None:
+            self._stop_send_socket.close()
+        if self._stop_recv_socket is not None:
+            self._stop_recv_socket.close()
 
         logger.debug("Closed responder socket.")
 
     def _thread_method(self):
         logger.debug("Listening for requests...")
 
-        while self._continue:
-            poller = zmq.Poller()
-            poller.register(self._zmq_socket, zmq.POLLIN)
+        poller = zmq.Poller()
+        poller.register(self._zmq_socket, zmq.POLLIN)
+        poller.register(self._stop_recv_socket, zmq.POLLIN)
 
-            events = poller.poll(500)
+        while self._continue:
+            # Block until a request or a stop signal arrives - the stop
+            # socket means no periodic wake-up is needed to notice shutdown
+            for socket, _event in poller.poll():
+                if socket is self._stop_recv_socket:
+                    self._stop_recv_socket.recv()
+                    return
 
-            if len(events) > 0:
                 request = self._zmq_socket.recv_string()
-                logger.debug("Request received: " + request)
+                logger.debug("Request received: %s", request)
 
                 response = self._process_request(request)
 
-                logger.debug("Sending response: " + response)
+                logger.debug("Sending response: %s", response)
                 self._zmq_socket.send_string(response)
 
     def _process_request(self, request):
         valid_message_format = False
         try:
             message = Message.from_string(request)
-            logger.debug("Received request: " + message.message_friendly_string())
-
-            if message.message_id() == Message.REQ_PING:
-                response = Message.from_parts(Message.RSP_PING, list())
-
-            elif message.message_id() == Message.REQ_GET_DEVICE_ID:
-                device_id = self._callback_client.on_request_get_device_id()
-                if device_id is None:
-                    device_id = -1
-                if isinstance(device_id, DeviceID):
-                    device_id = device_id.value
-
-                response = Message.from_parts(Message.RSP_GET_DEVICE_ID, [device_id])
-
-            elif message.message_id() == Message.REQ_GET_BRIGHTNESS:
-                brightness = self._callback_client.on_request_get_brightness()
-                if brightness is None:
-                    brightness = -1
-                response = Message.from_parts(Message.RSP_GET_BRIGHTNESS, [brightness])
-
-            elif message.message_id() == Message.REQ_SET_BRIGHTNESS:
-                self._callback_client.on_request_set_brightness(
-                    int(message.parameters[0])
-                )
-                response = Message.from_parts(Message.RSP_SET_BRIGHTNESS, list())
-
-            elif message.message_id() == Message.REQ_INCREMENT_BRIGHTNESS:
-                self._callback_client.on_request_increment_brightness()
-                response = Message.from_parts(Message.RSP_INCREMENT_BRIGHTNESS, list())
-
-            elif message.message_id() == Message.REQ_DECREMENT_BRIGHTNESS:
-                self._callback_client.on_request_decrement_brightness()
-                response = Message.from_parts(Message.RSP_DECREMENT_BRIGHTNESS, list())
-
-            elif message.message_id() == Message.REQ_BLANK_SCREEN:
-                self._callback_client.on_request_blank_screen()
-                response = Message.from_parts(Message.RSP_BLANK_SCREEN, list())
-
-            elif message.message_id() == Message.REQ_UNBLANK_SCREEN:
-                self._callback_client.on_request_unblank_screen()
-                response = Message.from_parts(Message.RSP_UNBLANK_SCREEN, list())
-
-            elif message.message_id() == Message.REQ_GET_BATTERY_STATE:
-                (
-                    charging_state,
-                    capacity,
-                    time_remaining,
-                    wattage,
-                ) = self._callback_client.on_request_battery_state()
-                response = Message.from_parts(
-                    Message.RSP_GET_BATTERY_STATE,
-                    [charging_state, capacity, time_remaining, wattage],
-                )
-
-            elif message.message_id() == Message.REQ_GET_PERIPHERAL_ENABLED:
-                enabled_bool = self._callback_client.on_request_get_peripheral_enabled(
-                    int(message.parameters[0])
-                )
-                enabled_int = int(enabled_bool is True)
-                response = Message.from_parts(
-                    Message.RSP_GET_PERIPHERAL_ENABLED, [enabled_int]
-                )
-
-            elif message.message_id() == Message.REQ_GET_SCREEN_BLANKING_TIMEOUT:
-                timeout = self._callback_client.on_request_get_screen_blanking_timeout()
-                if timeout is None:
-                    timeout = -1
-                response = Message.from_parts(
-                    Message.RSP_GET_SCREEN_BLANKING_TIMEOUT, [timeout]
-                )
-
-            elif message.message_id() == Message.REQ_SET_SCREEN_BLANKING_TIMEOUT:
-                self._callback_client.on_request_set_screen_blanking_timeout(
-                    int(message.parameters[0])
-                )
-                response = Message.from_parts(
-                    Message.RSP_SET_SCREEN_BLANKING_TIMEOUT, list()
-                )
-
-            elif message.message_id() == Message.REQ_GET_LID_OPEN_STATE:
-                lid_open_bool = self._callback_client.on_request_get_lid_open_state()
-                lid_open_int = int(lid_open_bool is True)
-                response = Message.from_parts(
-                    Message.RSP_GET_LID_OPEN_STATE, [lid_open_int]
-                )
-
-            elif message.message_id() == Message.REQ_GET_SCREEN_BACKLIGHT_STATE:
-                backlight_state = (
-                    self._callback_client.on_request_get_screen_backlight_state()
-                )
-                if backlight_state is None:
-                    backlight_state = -1
-                response = Message.from_parts(
-                    Message.RSP_GET_SCREEN_BACKLIGHT_STATE, [backlight_state]
-                )
-
-            elif message.message_id() == Message.REQ_SET_SCREEN_BACKLIGHT_STATE:
-                self._callback_client.on_request_set_screen_backlight_state(
-                    int(message.parameters[0])
-                )
-                response = Message.from_parts(
-                    Message.RSP_SET_SCREEN_BACKLIGHT_STATE, list()
-                )
-
-            elif message.message_id() == Message.REQ_GET_OLED_CONTROL:
-                oled_pi_control_state = (
-                    self._callback_client.on_request_get_oled_control()
-                )
-                if oled_pi_control_state is None:
-                    oled_pi_control_state = -1
-                response = Message.from_parts(
-                    Message.RSP_GET_OLED_CONTROL, [oled_pi_control_state]
-                )
-
-            elif message.message_id() == Message.REQ_SET_OLED_CONTROL:
-                self._callback_client.on_request_set_oled_pi_control(
-                    int(message.parameters[0])
-                )
-                response = Message.from_parts(Message.RSP_SET_OLED_CONTROL, list())
-
-            elif message.message_id() == Message.REQ_GET_OLED_SPI_BUS:
-                oled_spi_state = self._callback_client.on_request_get_oled_spi_bus()
-                if oled_spi_state is None:
-                    oled_spi_state = -1
-                response = Message.from_parts(
-                    Message.RSP_GET_OLED_SPI_BUS, [oled_spi_state]
-                )
-
-            elif message.message_id() == Message.REQ_SET_OLED_SPI_BUS:
-                # Operation takes a little while. We need to return a response ASAP
-                # so we put this into a thread
-                Thread(
-                    target=self._callback_client.on_request_set_oled_spi_bus,
-                    args=[int(message.parameters[0])],
-                ).start()
-                response = Message.from_parts(Message.RSP_SET_OLED_SPI_BUS)
+            # Only pay for friendly-stringification if the log gets emitted
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Received request: %s", message.message_friendly_string())
 
+            handler = self._HANDLERS.get(message.message_id())
+            if handler is not None:
+                response = handler(self, message.parameters)
             else:
                 logger.error("Unsupported request received: " + request)
-                response = Message.from_parts(Message.RSP_ERR_UNSUPPORTED, list())
+                response = self._STATIC_RESPONSES[Message.RSP_ERR_UNSUPPORTED]
 
             valid_message_format = True
 
         except ValueError as e:
             logger.error("Error processing message: " + str(e))
-            logger.info(traceback.format_exc())
-            response = Message.from_parts(Message.RSP_ERR_MALFORMED, list())
+            logger.info("Stack trace:", exc_info=True)
+            response = self._STATIC_RESPONSES[Message.RSP_ERR_MALFORMED]
 
         except Exception as e:
             logger.error("Unknown error processing message: " + str(e))
-            logger.info(traceback.format_exc())
-            response = Message.from_parts(Message.RSP_ERR_SERVER, list())
+            logger.info("Stack trace:", exc_info=True)
+            response = self._STATIC_RESPONSES[Message.RSP_ERR_SERVER]
 
-        if valid_message_format:
+        if valid_message_format and logger.isEnabledFor(logging.INFO):
             # Reduce output noise from RPi's polling lxpanel plugin
             if message.message_id() != Message.REQ_GET_BATTERY_STATE:
                 logger.info(
-                    "Recv: "
-                    + message.message_friendly_string()
-                    + " - Send: "
-                    + response.message_friendly_string()
+                    "Recv: %s - Send: %s",
+                    message.message_friendly_string(),
+                    response.message_friendly_string(),
                 )
 
         return response.to_string()
+
+    # Parameterless responses are identical on every request - build one
+    # instance of each and reuse it instead of allocating per reply
+    _STATIC_RESPONSES = {
+        rsp_id: Message.from_parts(rsp_id)
+        for rsp_id in (
+            Message.RSP_PING,
+            Message.RSP_SET_BRIGHTNESS,
+            Message.RSP_INCREMENT_BRIGHTNESS,
+            Message.RSP_DECREMENT_BRIGHTNESS,
+            Message.RSP_BLANK_SCREEN,
+            Message.RSP_UNBLANK_SCREEN,
+            Message.RSP_SET_SCREEN_BLANKING_TIMEOUT,
+            Message.RSP_SET_SCREEN_BACKLIGHT_STATE,
+            Message.RSP_SET_OLED_CONTROL,
+            Message.RSP_SET_OLED_SPI_BUS,
+            Message.RSP_ERR_SERVER,
+            Message.RSP_ERR_MALFORMED,
+            Message.RSP_ERR_UNSUPPORTED,
+        )
+    }
+
+    # Request handlers - one per message id, dispatched via _HANDLERS
+
+    def _on_ping(self, parameters):
+        return self._STATIC_RESPONSES[Message.RSP_PING]
+
+    def _on_get_device_id(self, parameters):
+        device_id = self._callback_client.on_request_get_device_id()
+        if device_id is None:
+            device_id = -1
+        if isinstance(device_id, DeviceID):
+            device_id = device_id.value
+
+        return Message.from_parts(Message.RSP_GET_DEVICE_ID, [device_id])
+
+    def _on_get_brightness(self, parameters):
+        brightness = self._callback_client.on_request_get_brightness()
+        if brightness is None:
+            brightness = -1
+        return Message.from_parts(Message.RSP_GET_BRIGHTNESS, [brightness])
+
+    def _on_set_brightness(self, parameters):
+        self._callback_client.on_request_set_brightness(int(parameters[0]))
+        return self._STATIC_RESPONSES[Message.RSP_SET_BRIGHTNESS]
+
+    def _on_increment_brightness(self, parameters):
+        self._callback_client.on_request_increment_brightness()
+        return self._STATIC_RESPONSES[Message.RSP_INCREMENT_BRIGHTNESS]
+
+    def _on_decrement_brightness(self, parameters):
+        self._callback_client.on_request_decrement_brightness()
+        return self._STATIC_RESPONSES[Message.RSP_DECREMENT_BRIGHTNESS]
+
+    def _on_blank_screen(self, parameters):
+        self._callback_client.on_request_blank_screen()
+        return self._STATIC_RESPONSES[Message.RSP_BLANK_SCREEN]
+
+    def _on_unblank_screen(self, parameters):
+        self._callback_client.on_request_unblank_screen()
+        return self._STATIC_RESPONSES[Message.RSP_UNBLANK_SCREEN]
+
+    def _on_get_battery_state(self, parameters):
+        (
+            charging_state,
+            capacity,
+            time_remaining,
+            wattage,
+        ) = self._callback_client.on_request_battery_state()
+        return Message.from_parts(
+            Message.RSP_GET_BATTERY_STATE,
+            [charging_state, capacity, time_remaining, wattage],
+        )
+
+    def _on_get_peripheral_enabled(self, parameters):
+        enabled_bool = self._callback_client.on_request_get_peripheral_enabled(
+            int(parameters[0])
+        )
+        enabled_int = int(enabled_bool is True)
+        return Message.from_parts(Message.RSP_GET_PERIPHERAL_ENABLED, [enabled_int])
+
+    def _on_get_screen_blanking_timeout(self, parameters):
+        timeout = self._callback_client.on_request_get_screen_blanking_timeout()
+        if timeout is None:
+            timeout = -1
+        return Message.from_parts(Message.RSP_GET_SCREEN_BLANKING_TIMEOUT, [timeout])
+
+    def _on_set_screen_blanking_timeout(self, parameters):
+        self._callback_client.on_request_set_screen_blanking_timeout(int(parameters[0]))
+        return self._STATIC_RESPONSES[Message.RSP_SET_SCREEN_BLANKING_TIMEOUT]
+
+    def _on_get_lid_open_state(self, parameters):
+        lid_open_bool = self._callback_client.on_request_get_lid_open_state()
+        lid_open_int = int(lid_open_bool is True)
+        return Message.from_parts(Message.RSP_GET_LID_OPEN_STATE, [lid_open_int])
+
+    def _on_get_screen_backlight_state(self, parameters):
+        backlight_state = self._callback_client.on_request_get_screen_backlight_state()
+        if backlight_state is None:
+            backlight_state = -1
+        return Message.from_parts(
+            Message.RSP_GET_SCREEN_BACKLIGHT_STATE, [backlight_state]
+        )
+
+    def _on_set_screen_backlight_state(self, parameters):
+        self._callback_client.on_request_set_screen_backlight_state(int(parameters[0]))
+        return self._STATIC_RESPONSES[Message.RSP_SET_SCREEN_BACKLIGHT_STATE]
+
+    def _on_get_oled_control(self, parameters):
+        oled_pi_control_state = self._callback_client.on_request_get_oled_control()
+        if oled_pi_control_state is None:
+            oled_pi_control_state = -1
+        return Message.from_parts(Message.RSP_GET_OLED_CONTROL, [oled_pi_control_state])
+
+    def _on_set_oled_control(self, parameters):
+        self._callback_client.on_request_set_oled_pi_control(int(parameters[0]))
+        return self._STATIC_RESPONSES[Message.RSP_SET_OLED_CONTROL]
+
+    def _on_get_oled_spi_bus(self, parameters):
+        oled_spi_state = self._callback_client.on_request_get_oled_spi_bus()
+        if oled_spi_state is None:
+            oled_spi_state = -1
+        return Message.from_parts(Message.RSP_GET_OLED_SPI_BUS, [oled_spi_state])
+
+    def _on_set_oled_spi_bus(self, parameters):
+        # Operation takes a little while. We need to return a response ASAP
+        # so we put this into a thread
+        Thread(
+            target=self._callback_client.on_request_set_oled_spi_bus,
+            args=[int(parameters[0])],
+        ).start()
+        return self._STATIC_RESPONSES[Message.RSP_SET_OLED_SPI_BUS]
+
+    _HANDLERS = {
+        Message.REQ_PING: _on_ping,
+        Message.REQ_GET_DEVICE_ID: _on_get_device_id,
+        Message.REQ_GET_BRIGHTNESS: _on_get_brightness,
+        Message.REQ_SET_BRIGHTNESS: _on_set_brightness,
+        Message.REQ_INCREMENT_BRIGHTNESS: _on_increment_brightness,
+        Message.REQ_DECREMENT_BRIGHTNESS: _on_decrement_brightness,
+        Message.REQ_BLANK_SCREEN: _on_blank_screen,
+        Message.REQ_UNBLANK_SCREEN: _on_unblank_screen,
+        Message.REQ_GET_BATTERY_STATE: _on_get_battery_state,
+        Message.REQ_GET_PERIPHERAL_ENABLED: _on_get_peripheral_enabled,
+        Message.REQ_GET_SCREEN_BLANKING_TIMEOUT: _on_get_screen_blanking_timeout,
+        Message.REQ_SET_SCREEN_BLANKING_TIMEOUT: _on_set_screen_blanking_timeout,
+        Message.REQ_GET_LID_OPEN_STATE: _on_get_lid_open_state,
+        Message.REQ_GET_SCREEN_BACKLIGHT_STATE: _on_get_screen_backlight_state,
+        Message.REQ_SET_SCREEN_BACKLIGHT_STATE: _on_set_screen_backlight_state,
+        Message.REQ_GET_OLED_CONTROL: _on_get_oled_control,
+        Message.REQ_SET_OLED_CONTROL: _on_set_oled_control,
+        Message.REQ_GET_OLED_SPI_BUS: _on_get_oled_spi_bus,
+        Message.REQ_SET_OLED_SPI_BUS: _on_set_oled_spi_bus,
+    }